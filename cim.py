@@ -6,87 +6,269 @@ from a specific Excel template.
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 import io
 from datetime import datetime
 
+# --- CIM FILE STRUCTURE DEFINITION ---
+# One icunis.p record, fine-tuned to match the exact BCF.cim format. The
+# fields are, in order: part, qty, site, location, lotref, ordernbr,
+# eff date, dr acct, dr acct.1. Lines end in '\r\n' to ensure
+# Windows-style line endings (CRLF).
+RECORD_TMPL = (
+    '@@batchload  icunis.p\r\n'
+    '"%s" \r\n'
+    '%s - - "%s" "%s" "" "" \r\n'
+    '"%s" - - "" "%s" %s %s %s \r\n'
+    '- \r\n'
+    '- \r\n'
+    '@@end\r\n'
+)
+
+# Bytes of generated content shown in the on-page preview.
+PREVIEW_BYTES = 8 * 1024
+
+# Template columns that are copied into the record as text.
+TEXT_COLUMNS = ['pt part', 'site', 'location', 'ordernbr', 'rmks']
+
+# Every template column the generator reads. The template has two 'dr acct'
+# columns; pandas renames the second to 'dr acct.1'. Anything else in the
+# sheet is skipped at read time.
+TEMPLATE_COLUMNS = TEXT_COLUMNS + ['lotserial qty', 'eff date', 'dr acct', 'dr acct.1']
+
+# Read-time dtypes. The numeric and date columns are left to inference
+# because generate_cim_content coerces them itself: forcing float64 here
+# would reject the whole upload over a single stray text cell.
+TEXT_DTYPES = {name: 'string' for name in TEXT_COLUMNS}
+
+def clean_dataframe(df):
+    """
+    Prepares a freshly read template for generate_cim_content: strips the
+    text columns once and drops rows without a usable part number.
+
+    Args:
+        df (pd.DataFrame): The DataFrame as read from the uploaded file.
+
+    Returns:
+        pd.DataFrame: The rows that should become CIM records.
+    """
+    # Build the row filter from a single stripped copy of 'pt part', then
+    # strip the other text columns for the surviving rows only.
+    pt_part = df['pt part'].astype('string').str.strip()
+    keep = pt_part.notna() & (pt_part != '') & (pt_part.str.lower() != 'nan')
+    df = df.loc[keep]
+    return df.assign(**{
+        name: df[name].astype('string').str.strip().fillna('')
+        for name in TEXT_COLUMNS if name in df and name != 'pt part'
+    }, **{'pt part': pt_part[keep]})
+
+def _text_column(df, name):
+    """
+    Returns a text column prepared by clean_dataframe, or blanks if the
+    column is missing.
+    """
+    if name not in df:
+        return pd.Series('', index=df.index, dtype=str)
+    return df[name]
+
+def _numeric_column(df, name):
+    """
+    Returns a column coerced to numbers as a NumPy array. Integer columns
+    stay integer so large values keep every digit; anything else becomes
+    float, using NaN for anything unparseable or a missing column.
+    """
+    if name not in df:
+        return np.full(len(df), np.nan)
+    values = pd.to_numeric(df[name], errors='coerce')
+    if values.dtype.kind in 'iu' and not values.isna().any():
+        return values.to_numpy()
+    return values.to_numpy(dtype=float, na_value=np.nan)
+
+def _int_text(values):
+    """
+    Returns integer text for integer values, or for float values truncated
+    towards zero. Floats outside the int64 range are formatted with Python's
+    int() instead of being cast, since the cast would silently wrap them.
+    """
+    if values.dtype.kind in 'iu':
+        return values.astype(str).astype(object)
+    big = np.abs(values) >= 2**63
+    text = np.where(big, 0, values).astype('int64').astype(str).astype(object)
+    text[big] = [str(int(value)) for value in values[big]]
+    return text
+
+def _parse_date(value):
+    """
+    Parses a single raw 'eff date' value, returning None if it is not a
+    valid date.
+    """
+    try:
+        date = pd.to_datetime(value)
+    except (ValueError, TypeError, OverflowError):
+        return None
+    return None if pd.isna(date) else date
+
+def _build_records(part, qty, site, location, lot_ref, order_nbr, eff_date, dr_acct1, dr_acct2):
+    """
+    Fills RECORD_TMPL in from plain NumPy arrays, one row at a time.
+
+    Returns:
+        bytes: The concatenated, UTF-8 encoded records.
+    """
+    # tolist() hands back native Python strings, which %-format much faster
+    # than NumPy scalars.
+    columns = [
+        col.tolist()
+        for col in (part, qty, site, location, lot_ref, order_nbr,
+                    eff_date, dr_acct1, dr_acct2)
+    ]
+
+    # map() keeps the per-row formatting in C. Each record is encoded
+    # straight onto one growing bytearray, so no list of per-record bytes
+    # objects is held alongside the output.
+    out = bytearray()
+    extend = out.extend
+    for record in map(RECORD_TMPL.__mod__, zip(*columns)):
+        extend(record.encode('utf-8'))
+
+    return bytes(out)
+
 def generate_cim_content(df):
     """
     Generates the multi-line .cim file content from a DataFrame, matching the
     specific format required by the 'icunis.p' program.
 
+    Each column is parsed and validated in a single vectorized pass and the
+    records are then filled in from plain NumPy arrays.
+
     Args:
-        df (pd.DataFrame): The DataFrame containing the source data.
+        df (pd.DataFrame): The source data, already passed through
+            clean_dataframe.
 
     Returns:
-        str: A string containing the full content for the .cim file.
+        bytes: The full UTF-8 encoded content for the .cim file.
     """
-    # Use newline='\r\n' to ensure Windows-style line endings (CRLF).
-    # The write() calls below will now only use '\n', which this object will
-    # automatically convert to the correct '\r\n'.
-    output = io.StringIO(newline='\r\n')
+    # --- 1. Data Extraction and Cleanup ---
+    pt_part = _text_column(df, 'pt part')
+
+    # Handle quantity formatting to be integer for whole numbers
+    qty_val = _numeric_column(df, 'lotserial qty')
+    bad = np.isinf(qty_val)
+    qty_val = np.where(np.isfinite(qty_val), qty_val, 0)
+    if qty_val.dtype.kind in 'iu':
+        qty_text = _int_text(qty_val)
+    else:
+        qty_text = np.where(qty_val == np.trunc(qty_val),
+                            _int_text(qty_val),
+                            qty_val.astype(str))
+    qty = pd.Series(qty_text, index=df.index)
+
+    site = _text_column(df, 'site')
+    location = _text_column(df, 'location')
 
-    # --- CIM FILE STRUCTURE DEFINITION ---
-    # This section is fine-tuned to match the exact BCF.cim format.
+    # --- CORRECTED MAPPING based on BCF.cim analysis ---
+    # The 'lotref' in the CIM file comes from the 'ordernbr' column in the template.
+    lot_ref = _text_column(df, 'ordernbr')
+    # The 'ordernbr' in the CIM file comes from the 'rmks' column in the template.
+    order_nbr = _text_column(df, 'rmks')
 
-    # Iterate through each row of the DataFrame
-    for index, row in df.iterrows():
+    # Handle date formatting. Each distinct raw value is parsed on its own:
+    # a whole-column parse guesses one format from the first row and reads
+    # every other value with it. An upload typically holds only a handful of
+    # distinct dates, so this stays cheap, and datetime cells need no parsing
+    # at all. Missing dates get code -1, which picks up the trailing ''.
+    # Dates that are present but cannot be parsed mark the row as bad.
+    eff_date_val = df['eff date'] if 'eff date' in df else pd.Series(index=df.index, dtype=object)
+    codes, uniques = pd.factorize(eff_date_val)
+    if not isinstance(uniques, pd.DatetimeIndex):
+        uniques = [_parse_date(value) for value in uniques]
+    failed = np.array([date is None for date in uniques] + [False], dtype=bool)
+    bad |= failed[codes]
+    # The d/m/yy label is built by hand because strftime's unpadded '%-d'
+    # and '%-m' are not supported on Windows.
+    labels = np.array(
+        ['' if date is None else f'{date.day}/{date.month}/{date.year % 100:02d}'
+         for date in uniques] + [''],
+        dtype=object,
+    )
+    eff_date = pd.Series(labels[codes], index=df.index)
+
+    # The template has two 'dr acct' columns. Pandas renames the second to 'dr acct.1'
+    # Convert to numeric, then int text to remove any '.0'
+    dr_accts = []
+    for name in ('dr acct', 'dr acct.1'):
+        acct_val = _numeric_column(df, name)
+        bad |= np.isinf(acct_val)
+        acct_val = np.where(np.isfinite(acct_val), acct_val, 0)
+        dr_accts.append(pd.Series(_int_text(acct_val), index=df.index))
+    dr_acct1, dr_acct2 = dr_accts
+
+    # Rows that fail are noted in a single warning and left out
+    if bad.any():
+        bad_rows = ', '.join(str(index + 2) for index in df.index[bad])
+        st.warning(f"Skipped {bad.sum()} row(s) due to an invalid date or number: {bad_rows}. Please check the data in these rows.")
+
+    # --- 2. CIM Record Construction ---
+    # Hand the kept rows over as plain NumPy arrays, so the builder never
+    # goes through pandas per row.
+    keep = ~bad
+    columns = [
+        col.to_numpy()[keep]
+        for col in (pt_part, qty, site, location, lot_ref, order_nbr,
+                    eff_date, dr_acct1, dr_acct2)
+    ]
+    return _build_records(*columns)
+
+@st.cache_data(show_spinner=False)
+def load_template(file_name, file_bytes):
+    """
+    Reads an uploaded template and cleans it with clean_dataframe. Cached on
+    the raw upload, so Streamlit reruns for the same file skip the parse.
+
+    Args:
+        file_name (str): Name of the uploaded file, used to pick the reader.
+        file_bytes (bytes): Raw content of the uploaded file.
+
+    Returns:
+        pd.DataFrame: The rows that should become CIM records.
+    """
+    # --- File Reading Logic ---
+    # The template has header lines that need to be skipped. Only the
+    # template columns are parsed, and the text columns are read
+    # straight into the string dtype to skip type inference.
+    read_options = dict(
+        skiprows=[0, 2, 3, 4],
+        usecols=lambda name: name in TEMPLATE_COLUMNS,
+        dtype=TEXT_DTYPES,
+    )
+    if file_name.endswith('.csv'):
+        df = pd.read_csv(io.BytesIO(file_bytes), **read_options)
+    else:
+        # The Rust-backed calamine engine parses .xlsx/.xls much faster
+        # than openpyxl; fall back to openpyxl if it is not installed.
         try:
-            # --- 1. Data Extraction and Cleanup ---
-            pt_part = str(row.get('pt part', '')).strip()
-
-            # Skip rows where the part number is empty
-            if not pt_part or pt_part.lower() == 'nan':
-                continue
-
-            # Handle quantity formatting to be integer for whole numbers
-            qty_val = pd.to_numeric(row.get('lotserial qty'), errors='coerce')
-            if pd.isna(qty_val):
-                qty = '0'
-            elif qty_val == int(qty_val): # Check if it's a whole number
-                qty = str(int(qty_val))
-            else:
-                qty = str(qty_val)
-
-            site = str(row.get('site', '')).strip()
-            location = str(row.get('location', '')).strip()
-
-            # --- CORRECTED MAPPING based on BCF.cim analysis ---
-            # The 'lotref' in the CIM file comes from the 'ordernbr' column in the template.
-            lot_ref = str(row.get('ordernbr', '')).strip()
-            # The 'ordernbr' in the CIM file comes from the 'rmks' column in the template.
-            order_nbr = str(row.get('rmks', '')).strip()
-
-            # Handle date formatting
-            eff_date_val = row.get('eff date')
-            if pd.notna(eff_date_val):
-                eff_date = pd.to_datetime(eff_date_val).strftime('%-d/%-m/%y')
-            else:
-                eff_date = ""
-
-            # The template has two 'dr acct' columns. Pandas renames the second to 'dr acct.1'
-            # Convert to numeric, then int, then string to remove any '.0'
-            dr_acct1_val = pd.to_numeric(row.get('dr acct'), errors='coerce')
-            dr_acct1 = str(int(dr_acct1_val)) if pd.notna(dr_acct1_val) else '0'
-
-            dr_acct2_val = pd.to_numeric(row.get('dr acct.1'), errors='coerce')
-            dr_acct2 = str(int(dr_acct2_val)) if pd.notna(dr_acct2_val) else '0'
-
-
-            # --- 2. CIM Record Construction (Corrected to use '\n' which gets converted to '\r\n') ---
-            output.write("@@batchload  icunis.p\n")
-            output.write(f'"{pt_part}" \n')
-            output.write(f'{qty} - - "{site}" "{location}" "" "" \n')
-            output.write(f'"{lot_ref}" - - "" "{order_nbr}" {eff_date} {dr_acct1} {dr_acct2} \n')
-            output.write("- \n")
-            output.write("- \n")
-            output.write("@@end\n")
-
-        except Exception as e:
-            # If a row fails, we can note it and continue
-            st.warning(f"Skipping row {index + 2} due to an error: {e}. Please check the data in this row.")
-            continue
-
-    return output.getvalue()
+            df = pd.read_excel(io.BytesIO(file_bytes), engine='calamine', **read_options)
+        except ImportError:
+            df = pd.read_excel(io.BytesIO(file_bytes), engine='openpyxl', **read_options)
+
+    # Clean up the DataFrame: strip the text columns and remove rows
+    # where 'pt part' is not present
+    return clean_dataframe(df)
+
+@st.cache_data(show_spinner=False)
+def generate_cim_file(file_name, file_bytes):
+    """
+    Cached wrapper around generate_cim_content for an uploaded template, so
+    the .cim content is only built once per unique upload.
+
+    Args:
+        file_name (str): Name of the uploaded file, used to pick the reader.
+        file_bytes (bytes): Raw content of the uploaded file.
+
+    Returns:
+        bytes: The full UTF-8 encoded content for the .cim file.
+    """
+    return generate_cim_content(load_template(file_name, file_bytes))
 
 # --- Streamlit App UI ---
 st.set_page_config(layout="wide")
@@ -97,33 +279,29 @@ uploaded_file = st.file_uploader("Choose an Excel or CSV file", type=["xlsx", "x
 
 if uploaded_file is not None:
     try:
-        # --- File Reading Logic ---
-        # The template has header lines that need to be skipped.
-        if uploaded_file.name.endswith('.csv'):
-            df = pd.read_csv(uploaded_file, skiprows=[0, 2, 3, 4])
-        else:
-            df = pd.read_excel(uploaded_file, skiprows=[0, 2, 3, 4], engine='openpyxl')
-
-        # Clean up the DataFrame: remove rows where 'pt part' is not present
-        df.dropna(subset=['pt part'], inplace=True)
-        # Further filter out any rows that might be empty strings after stripping
-        df = df[df['pt part'].astype(str).str.strip() != '']
+        file_bytes = uploaded_file.getvalue()
+        df = load_template(uploaded_file.name, file_bytes)
 
         st.success("File successfully uploaded and parsed.")
         st.write("### Data Preview (First 5 Rows)")
         st.dataframe(df.head())
 
         # Generate the .cim file content in memory
-        cim_data = generate_cim_content(df)
+        cim_data = generate_cim_file(uploaded_file.name, file_bytes)
 
         if cim_data:
             st.write("### Generated .cim File Preview")
-            st.text_area("CIM Content", cim_data, height=300)
+            # Only the head of the file goes into the preview; a multi-MB
+            # text area stalls the browser.
+            preview_label = "CIM Content"
+            if len(cim_data) > PREVIEW_BYTES:
+                preview_label += f" (first {PREVIEW_BYTES // 1024} KB)"
+            st.text_area(preview_label, cim_data[:PREVIEW_BYTES].decode('utf-8', 'replace'), height=300)
 
             # Provide a download button for the generated file
             st.download_button(
                 label="Download .cim File",
-                data=cim_data.encode('utf-8'), # Encode for consistency
+                data=cim_data,
                 file_name="unplanned_issue.cim",
                 mime="text/plain",
             )